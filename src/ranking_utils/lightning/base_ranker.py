@@ -1,5 +1,5 @@
 import abc
-from typing import Any, Dict, Iterable, Optional, Sequence, Tuple, Union
+from typing import Any, Dict, Iterable, Mapping, Optional, Sequence, Tuple, Union
 
 import torch
 from torch.utils.data import DataLoader, Dataset
@@ -25,18 +25,60 @@ PairwiseTrainBatch = Tuple[InputBatch, InputBatch]
 ValTestBatch = Tuple[torch.LongTensor, torch.LongTensor, InputBatch, torch.LongTensor]
 
 
+def _cat_inputs(a: InputBatch, b: InputBatch) -> Optional[InputBatch]:
+    """Concatenate two input batches of the same shape along the batch dimension. Tensors, sequences and mappings
+    of tensors are supported.
+
+    Args:
+        a (InputBatch): First input batch
+        b (InputBatch): Second input batch
+
+    Returns:
+        Optional[InputBatch]: The combined batch, or None if the batches can not be concatenated
+    """
+    if isinstance(a, torch.Tensor) and isinstance(b, torch.Tensor):
+        # e.g. sequences padded to different lengths; equal batch sizes are required to split the outputs
+        if a.dim() == 0 or a.shape != b.shape:
+            return None
+        return torch.cat([a, b])
+
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        if len(a) != len(b):
+            return None
+        items = [_cat_inputs(x, y) for x, y in zip(a, b)]
+        if any(item is None for item in items):
+            return None
+        return items if isinstance(a, list) else tuple(items)
+
+    if isinstance(a, Mapping) and isinstance(b, Mapping):
+        if a.keys() != b.keys():
+            return None
+        items = {k: _cat_inputs(a[k], b[k]) for k in a}
+        if any(item is None for item in items.values()):
+            return None
+        return items
+
+    return None
+
+
 class DatalessBaseRanker(LightningModule, abc.ABC):
     """Abstract base class for re-rankers. Implements average precision and reciprocal rank validation.
     This class needs to be extended and (at least) the following methods must be implemented:
         * forward
         * configure_optimizers (if not supplied in the DataModule)
 
+    Pairwise training scores positives and negatives in a single forward pass by default. Models with
+    batch-dependent layers (e.g. BatchNorm in training mode) should set `fuse_pairwise_forward = False`.
+
     Args:
         hparams (Dict[str, Any]): All model hyperparameters
         training_mode (str): 'pointwise' or 'pairwise'
         loss_margin (float, optional): Margin used in pairwise loss
     """
 
+    # concatenate positive and negative inputs for a single forward pass in pairwise training
+    fuse_pairwise_forward = True
+
     def __init__(
         self,
         hparams: Optional[Dict[str, Any]] = None,
@@ -78,6 +120,9 @@ class DatalessBaseRanker(LightningModule, abc.ABC):
         self, batch: Union[PointwiseTrainBatch, PairwiseTrainBatch], batch_idx: int
     ) -> torch.Tensor:
         """Train a single batch.
+        In pairwise mode, positives and negatives are concatenated and scored in a single forward pass if
+        `fuse_pairwise_forward` is set and the inputs have the same shapes. Batch-dependent layers (e.g. BatchNorm
+        in training mode) then see positives and negatives together, which changes the loss.
 
         Args:
             batch (Union[PointwiseTrainBatch, PairwiseTrainBatch]): A training batch, depending on the mode
@@ -91,8 +136,17 @@ class DatalessBaseRanker(LightningModule, abc.ABC):
             loss = self.bce(self(inputs).flatten(), labels.flatten())
         elif self.training_mode == "pairwise":
             pos_inputs, neg_inputs = batch
-            pos_outputs = torch.sigmoid(self(pos_inputs))
-            neg_outputs = torch.sigmoid(self(neg_inputs))
+            inputs = (
+                _cat_inputs(pos_inputs, neg_inputs)
+                if self.fuse_pairwise_forward
+                else None
+            )
+            if inputs is not None:
+                # positives and negatives have the same batch size, use a single forward pass
+                pos_outputs, neg_outputs = torch.sigmoid(self(inputs)).chunk(2)
+            else:
+                pos_outputs = torch.sigmoid(self(pos_inputs))
+                neg_outputs = torch.sigmoid(self(neg_inputs))
             loss = torch.mean(
                 torch.clamp(self.loss_margin - pos_outputs + neg_outputs, min=0)
             )
@@ -209,12 +263,21 @@ class BaseRanker(DatalessBaseRanker, abc.ABC):
         self.test_ds = test_ds
 
     def _build_dataloader(self, dataset: Dataset, shuffle: bool) -> DataLoader:
+        # keep the workers alive between epochs and prepare batches ahead of time
+        worker_kwargs = (
+            {"persistent_workers": True, "prefetch_factor": 4}
+            if self.num_workers > 0
+            else {}
+        )
         return DataLoader(
             dataset,
             shuffle=shuffle,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             collate_fn=getattr(dataset, "collate_fn", None),
+            # allows asynchronous host to device transfers
+            pin_memory=torch.cuda.is_available(),
+            **worker_kwargs,
         )
 
     def train_dataloader(self) -> DataLoader:
@@ -3,6 +3,7 @@ from typing import Any, Tuple
 
 import abc
 import h5py
+import numpy as np
 from torch.utils.data import Dataset
 
 
@@ -179,6 +180,34 @@ class ValTestDatasetBase(Dataset, abc.ABC):
         with h5py.File(self.data_file, "r") as fp:
             return fp["orig_doc_ids"].asstr()[doc_id]
 
+    def get_original_query_ids(self, q_ids: np.ndarray) -> np.ndarray:
+        """Return the original (string) query IDs for multiple internal IDs using a single read.
+
+        Args:
+            q_ids (np.ndarray): Internal query IDs
+
+        Returns:
+            np.ndarray: Original query IDs
+        """
+        # h5py requires increasing indices
+        unique_ids, inverse = np.unique(q_ids, return_inverse=True)
+        with h5py.File(self.data_file, "r") as fp:
+            return fp["orig_q_ids"].asstr()[unique_ids].astype(str)[inverse]
+
+    def get_original_document_ids(self, doc_ids: np.ndarray) -> np.ndarray:
+        """Return the original (string) document IDs for multiple internal IDs using a single read.
+
+        Args:
+            doc_ids (np.ndarray): Internal document IDs
+
+        Returns:
+            np.ndarray: Original document IDs
+        """
+        # h5py requires increasing indices
+        unique_ids, inverse = np.unique(doc_ids, return_inverse=True)
+        with h5py.File(self.data_file, "r") as fp:
+            return fp["orig_doc_ids"].asstr()[unique_ids].astype(str)[inverse]
+
     @abc.abstractmethod
     def get_single_input(self, query: str, doc: str) -> Input:
         """Create a single model input from a query and a document.
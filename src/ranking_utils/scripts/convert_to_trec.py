@@ -9,7 +9,7 @@ from ranking_utils.util import read_predictions, write_trec_eval_file
 
 def main():
     ap = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    ap.add_argument("PREDICTION_FILES", nargs="+", help="Prediction files (.pkl)")
+    ap.add_argument("PREDICTION_FILES", nargs="+", help="Prediction files (.npz)")
     ap.add_argument(
         "--out_file", default="out.tsv", help="Output file to use with TREC-eval"
     )
@@ -1,12 +1,14 @@
+import os
 import csv
-import pickle
 import tempfile
 from pathlib import Path
-from collections import defaultdict
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, Iterable, List, Tuple
 
 import h5py
 import torch
+import numpy as np
 from tqdm import tqdm
 from pytorch_lightning import Trainer
 
@@ -14,6 +16,10 @@ from ranking_utils.lightning.base_ranker import BaseRanker
 from ranking_utils.lightning.datasets import ValTestDatasetBase
 
 
+# query IDs mapped to arrays of document IDs and corresponding scores
+Predictions = Dict[str, Tuple[np.ndarray, np.ndarray]]
+
+
 def predict_and_save(trainer: Trainer, test_ds: ValTestDatasetBase):
     """Predict and save predictions in a file. The file is created in the `log_dir` of the trainer.
     Original query and document IDs are recovered and written in the files.
@@ -23,107 +29,233 @@ def predict_and_save(trainer: Trainer, test_ds: ValTestDatasetBase):
         trainer (Trainer): Trainer object with associated model
         test_ds (ValTestDatasetBase): Test dataset used to recover original IDs
     """
-    out_dict = defaultdict(list)
+    q_ids, doc_ids, predictions = [], [], []
     for item in trainer.predict():
-        out_dict["q_ids"].extend(
-            map(test_ds.get_original_query_id, item["q_ids"].tolist())
-        )
-        out_dict["doc_ids"].extend(
-            map(test_ds.get_original_document_id, item["doc_ids"].tolist())
+        q_ids.append(item["q_ids"])
+        doc_ids.append(item["doc_ids"])
+        predictions.append(item["predictions"])
+
+    f = Path(trainer.log_dir) / f"predictions_{trainer.local_rank}.npz"
+    # a rank may not receive any batches, write an empty file so that all ranks can be combined
+    if len(predictions) == 0:
+        np.savez_compressed(
+            f,
+            q_ids=np.array([], dtype=str),
+            doc_ids=np.array([], dtype=str),
+            predictions=np.array([], dtype=np.float32),
         )
-        out_dict["predictions"].extend(item["predictions"].tolist())
+        return
 
-    f = Path(trainer.log_dir) / f"predictions_{trainer.local_rank}.pkl"
-    with open(f, "wb") as fp:
-        pickle.dump(out_dict, fp)
+    np.savez_compressed(
+        f,
+        q_ids=test_ds.get_original_query_ids(torch.cat(q_ids).cpu().numpy()),
+        doc_ids=test_ds.get_original_document_ids(torch.cat(doc_ids).cpu().numpy()),
+        # numpy does not support e.g. bfloat16
+        predictions=torch.cat(predictions).float().cpu().numpy(),
+    )
 
 
-def read_predictions(files: Iterable[Path]) -> Dict[str, Dict[str, float]]:
-    """Read and combine predictions from .pkl files.
+def _group_predictions(
+    q_ids: np.ndarray, doc_ids: np.ndarray, predictions: np.ndarray
+) -> Predictions:
+    """Group predictions by query. The documents of each query are sorted by ID.
+    If a query-document pair occurs more than once, the last score is used.
+
+    Args:
+        q_ids (np.ndarray): Original query IDs
+        doc_ids (np.ndarray): Original document IDs
+        predictions (np.ndarray): Scores
+
+    Returns:
+        Predictions: Query IDs mapped to document IDs and scores
+    """
+    if len(q_ids) == 0:
+        return {}
+
+    # sort by query ID, then document ID; lexsort is stable, so duplicates keep their order
+    order = np.lexsort((doc_ids, q_ids))
+    q_ids, doc_ids, predictions = q_ids[order], doc_ids[order], predictions[order]
+
+    # keep only the last occurrence of each query-document pair
+    keep = np.ones(len(q_ids), dtype=bool)
+    keep[:-1] = (q_ids[1:] != q_ids[:-1]) | (doc_ids[1:] != doc_ids[:-1])
+    q_ids, doc_ids = q_ids[keep], doc_ids[keep]
+    predictions = predictions[keep].astype(np.float32)
+
+    # one group per query
+    splits = np.flatnonzero(q_ids[1:] != q_ids[:-1]) + 1
+    starts = np.concatenate([[0], splits])
+    return dict(
+        zip(
+            q_ids[starts].tolist(),
+            zip(np.split(doc_ids, splits), np.split(predictions, splits)),
+        )
+    )
+
+
+def read_predictions(files: Iterable[Path]) -> Predictions:
+    """Read and combine predictions from .npz files.
 
     Args:
         files (Iterable[Path]): All files to read
 
     Returns:
-        Dict[str, Dict[str, float]]: Query IDs mapped to document IDs mapped to scores
+        Predictions: Query IDs mapped to document IDs and scores
     """
-    result = defaultdict(dict)
+    q_ids, doc_ids, predictions = [], [], []
     for f in files:
-        with open(f, "rb") as fp:
-            d = pickle.load(fp)
-            for q_id, doc_id, prediction in zip(
-                d["q_ids"], d["doc_ids"], d["predictions"]
-            ):
-                result[q_id][doc_id] = prediction
-    return result
+        with np.load(f) as d:
+            q_ids.append(d["q_ids"])
+            doc_ids.append(d["doc_ids"])
+            predictions.append(d["predictions"])
+    if len(q_ids) == 0:
+        return {}
+    return _group_predictions(
+        np.concatenate(q_ids), np.concatenate(doc_ids), np.concatenate(predictions)
+    )
 
 
-def write_trec_eval_file(
-    out_file: Path, predictions: Dict[str, Dict[str, float]], name: str
-):
+def write_trec_eval_file(out_file: Path, predictions: Predictions, name: str):
     """Write the results in a file accepted by the TREC evaluation tool.
 
     Args:
         out_file (Path): File to create
-        predictions (Dict[str, Dict[str, float]]): Query IDs mapped to document IDs mapped to scores
+        predictions (Predictions): Query IDs mapped to document IDs and scores
         name (str): Method name
     """
     out_file.parent.mkdir(parents=True, exist_ok=True)
     with open(out_file, "w", encoding="utf-8", newline="") as fp:
         writer = csv.writer(fp, delimiter="\t")
-        for q_id in predictions:
-            ranking = sorted(
-                predictions[q_id].keys(), key=predictions[q_id].get, reverse=True
+        for q_id, (doc_ids, scores) in predictions.items():
+            # a stable sort keeps ties in document ID order (see _group_predictions)
+            ranking = np.argsort(-scores, kind="stable")
+            writer.writerows(
+                zip(
+                    repeat(q_id),
+                    repeat("Q0"),
+                    doc_ids[ranking].tolist(),
+                    range(1, len(ranking) + 1),
+                    scores[ranking],
+                    repeat(name),
+                )
             )
-            for rank, doc_id in enumerate(ranking, 1):
-                score = predictions[q_id][doc_id]
-                writer.writerow([q_id, "Q0", doc_id, rank, score, name])
+
+
+def _create_testset(
+    runfile: Path,
+    out_file: str,
+    int_q_ids: Dict[str, int],
+    int_doc_ids: Dict[str, int],
+):
+    """Create a re-ranking testset from a runfile.
+
+    Args:
+        runfile (Path): Runfile to create the testset for (TREC format)
+        out_file (str): File to write the testset to
+        int_q_ids (Dict[str, int]): Original query IDs mapped to internal query IDs
+        int_doc_ids (Dict[str, int]): Original document IDs mapped to internal document IDs
+    """
+    qd_pairs = []
+    with open(runfile) as fp:
+        for line in fp:
+            q_id, _, doc_id, _, _, _ = line.split()
+            qd_pairs.append((q_id, doc_id))
+    num_items = len(qd_pairs)
+    q_ids = np.fromiter(
+        (int_q_ids[q_id] for q_id, _ in qd_pairs), dtype=np.int32, count=num_items
+    )
+    doc_ids = np.fromiter(
+        (int_doc_ids[doc_id] for _, doc_id in qd_pairs),
+        dtype=np.int32,
+        count=num_items,
+    )
+    # write each dataset at once rather than item by item; the datasets are not compressed, as
+    # ValTestDatasetBase reopens the file for every item and would decompress a whole chunk each time
+    with h5py.File(out_file, "w") as fp:
+        fp.create_dataset("q_ids", data=q_ids)
+        fp.create_dataset("doc_ids", data=doc_ids)
+        fp.create_dataset("labels", (num_items,), dtype="int32")
+
+
+# internal query and document IDs, only set in worker processes by _init_testset_worker
+_worker_int_q_ids: Dict[str, int] = {}
+_worker_int_doc_ids: Dict[str, int] = {}
+
+
+def _init_testset_worker(int_q_ids: Dict[str, int], int_doc_ids: Dict[str, int]):
+    """Initialize a worker process for `_create_testset_in_worker`.
+    The ID mappings are transferred only once per worker.
+
+    Args:
+        int_q_ids (Dict[str, int]): Original query IDs mapped to internal query IDs
+        int_doc_ids (Dict[str, int]): Original document IDs mapped to internal document IDs
+    """
+    global _worker_int_q_ids, _worker_int_doc_ids
+    _worker_int_q_ids = int_q_ids
+    _worker_int_doc_ids = int_doc_ids
+
+
+def _create_testset_in_worker(runfile: Path, out_file: str):
+    """Create a re-ranking testset in a worker process initialized by `_init_testset_worker`.
+
+    Args:
+        runfile (Path): Runfile to create the testset for (TREC format)
+        out_file (str): File to write the testset to
+    """
+    _create_testset(runfile, out_file, _worker_int_q_ids, _worker_int_doc_ids)
 
 
 def create_temp_testsets(
-    data_file: Path, runfiles: Iterable[Path]
+    data_file: Path, runfiles: Iterable[Path], num_workers: int = 4
 ) -> List[Tuple[int, str]]:
-    """Create re-ranking testsets in a temporary files.
+    """Create re-ranking testsets in a temporary files. Multiple runfiles are processed in parallel.
+    Each worker process holds its own copy of the query and document ID mappings (these are pickled
+    unless processes are forked), hence peak memory grows with the number of workers for large collections.
 
     Args:
         data_file (Path): Pre-processed data file containing queries and documents
         runfiles (Iterable[Path]): Runfiles to create testsets for (TREC format)
+        num_workers (int, optional): Maximum number of worker processes (at least 1). Defaults to 4.
 
     Returns:
         List[Tuple[int, str]]: Descriptors and paths of the temporary files
     """
-    # recover the internal integer query and doc IDs
-    int_q_ids = {}
-    int_doc_ids = {}
+    if num_workers < 1:
+        raise ValueError(f"Invalid number of workers: {num_workers}")
+
+    # recover the internal integer query and doc IDs, reading each dataset at once
     with h5py.File(data_file, "r") as fp:
-        for int_id, orig_id in enumerate(
-            tqdm(fp["orig_q_ids"].asstr(), total=len(fp["orig_q_ids"]))
-        ):
-            int_q_ids[orig_id] = int_id
-        for int_id, orig_id in enumerate(
-            tqdm(fp["orig_doc_ids"].asstr(), total=len(fp["orig_doc_ids"]))
-        ):
-            int_doc_ids[orig_id] = int_id
+        orig_q_ids = fp["orig_q_ids"].asstr()[:]
+        orig_doc_ids = fp["orig_doc_ids"].asstr()[:]
+    int_q_ids = {orig_id: int_id for int_id, orig_id in enumerate(orig_q_ids)}
+    int_doc_ids = {orig_id: int_id for int_id, orig_id in enumerate(orig_doc_ids)}
 
+    # the temporary files are created here, as file descriptors are only valid within a process
+    runfiles = list(runfiles)
     result = []
-    for runfile in runfiles:
-        qd_pairs = []
-        with open(runfile) as fp:
-            for line in fp:
-                q_id, _, doc_id, _, _, _ = line.split()
-                qd_pairs.append((q_id, doc_id))
-        fd, f = tempfile.mkstemp()
-        with h5py.File(f, "w") as fp:
-            num_items = len(qd_pairs)
-            ds = {
-                "q_ids": fp.create_dataset("q_ids", (num_items,), dtype="int32"),
-                "doc_ids": fp.create_dataset("doc_ids", (num_items,), dtype="int32"),
-                "labels": fp.create_dataset("labels", (num_items,), dtype="int32"),
-            }
-            for i, (q_id, doc_id) in enumerate(tqdm(qd_pairs, desc="Saving testset")):
-                ds["q_ids"][i] = int_q_ids[q_id]
-                ds["doc_ids"][i] = int_doc_ids[doc_id]
-        result.append((fd, f))
+    try:
+        for _ in runfiles:
+            result.append(tempfile.mkstemp())
+        out_files = [f for _, f in result]
+
+        # transferring the ID mappings to a worker is not worth it for a single runfile
+        if len(runfiles) <= 1 or num_workers == 1:
+            for runfile, out_file in zip(runfiles, out_files):
+                _create_testset(runfile, out_file, int_q_ids, int_doc_ids)
+        else:
+            with ProcessPoolExecutor(
+                max_workers=min(num_workers, len(runfiles)),
+                initializer=_init_testset_worker,
+                initargs=(int_q_ids, int_doc_ids),
+            ) as executor:
+                # consume the iterator so that exceptions from the workers are raised
+                list(executor.map(_create_testset_in_worker, runfiles, out_files))
+    except BaseException:
+        # none of the temporary files are returned, so they are removed here
+        for fd, f in result:
+            os.close(fd)
+            os.remove(f)
+        raise
     return result
 
 
@@ -132,7 +264,7 @@ def rank(
     testset: ValTestDatasetBase,
     batch_size: int,
     num_workers: int = 16,
-) -> Dict[str, Dict[str, float]]:
+) -> Predictions:
     """Rank all query-document pairs in a testset using a trained ranking model.
 
     Args:
@@ -142,11 +274,12 @@ def rank(
         num_workers (int, optional): Number of DataLoader workers. Defaults to 16.
 
     Returns:
-        Dict[str, Dict[str, float]]: Query IDs mapped to document IDs mapped to scores
+        Predictions: Query IDs mapped to document IDs and scores
     """
+    # DataParallel scatters and gathers every batch in Python and rarely pays off for inference,
+    # use a single device and a larger batch size instead (or predict_and_save for multiple GPUs)
     if torch.cuda.is_available():
         print("CUDA available")
-        model = torch.nn.DataParallel(model)
         dev = "cuda:0"
     else:
         print("CUDA unavailable")
@@ -154,20 +287,29 @@ def rank(
     model.to(dev)
     model.eval()
 
+    # the DataLoader is only iterated once, so persistent workers would not help here
+    worker_kwargs = {"prefetch_factor": 4} if num_workers > 0 else {}
     dl = torch.utils.data.DataLoader(
         testset,
         batch_size=batch_size,
         num_workers=num_workers,
         collate_fn=testset.collate_fn,
+        pin_memory=torch.cuda.is_available(),
+        **worker_kwargs,
     )
-    result = defaultdict(dict)
-    for q_ids, doc_ids, inputs, _ in tqdm(dl):
-        with torch.no_grad():
-            inputs = [i.to(dev) for i in inputs]
+    q_ids, doc_ids, predictions = [], [], []
+    for batch_q_ids, batch_doc_ids, inputs, _ in tqdm(dl):
+        with torch.inference_mode():
+            inputs = [i.to(dev, non_blocking=True) for i in inputs]
             outputs = model(inputs)
-        for q_id, doc_id, prediction in zip(q_ids, doc_ids, outputs):
-            orig_q_id = testset.get_original_query_id(q_id.cpu())
-            orig_doc_id = testset.get_original_document_id(doc_id.cpu())
-            prediction = prediction.detach().cpu().numpy()[0]
-            result[orig_q_id][orig_doc_id] = prediction
-    return result
+        q_ids.append(batch_q_ids.numpy())
+        doc_ids.append(batch_doc_ids.numpy())
+        predictions.append(outputs.detach().float().cpu().numpy().reshape(-1))
+
+    if len(predictions) == 0:
+        return {}
+
+    # recover all original IDs at once
+    orig_q_ids = testset.get_original_query_ids(np.concatenate(q_ids))
+    orig_doc_ids = testset.get_original_document_ids(np.concatenate(doc_ids))
+    return _group_predictions(orig_q_ids, orig_doc_ids, np.concatenate(predictions))
@@ -0,0 +1,91 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("torchmetrics")
+
+from ranking_utils.lightning.base_ranker import DatalessBaseRanker, _cat_inputs
+
+
+class DummyRanker(DatalessBaseRanker):
+    def __init__(self):
+        super().__init__(training_mode="pairwise", loss_margin=0.2)
+        self.batch_sizes = []
+
+    def forward(self, inputs: torch.Tensor) -> torch.Tensor:
+        self.batch_sizes.append(len(inputs))
+        # the score of each input is its first feature
+        return inputs[:, :1]
+
+    def configure_optimizers(self):
+        pass
+
+
+def test_cat_inputs_tensor():
+    a, b = torch.zeros(2, 3), torch.ones(2, 3)
+    assert torch.equal(_cat_inputs(a, b), torch.cat([a, b]))
+
+
+def test_cat_inputs_tuple():
+    a = (torch.zeros(2, 3), torch.zeros(2))
+    b = (torch.ones(2, 3), torch.ones(2))
+    result = _cat_inputs(a, b)
+    assert isinstance(result, tuple)
+    assert torch.equal(result[0], torch.cat([a[0], b[0]]))
+    assert torch.equal(result[1], torch.cat([a[1], b[1]]))
+
+
+def test_cat_inputs_mapping():
+    a = {"input_ids": torch.zeros(2, 3), "attention_mask": torch.zeros(2, 3)}
+    b = {"input_ids": torch.ones(2, 3), "attention_mask": torch.ones(2, 3)}
+    result = _cat_inputs(a, b)
+    assert result.keys() == a.keys()
+    for k in a:
+        assert torch.equal(result[k], torch.cat([a[k], b[k]]))
+
+
+@pytest.mark.parametrize(
+    "a, b",
+    [
+        # different sequence lengths
+        (torch.zeros(2, 3), torch.zeros(2, 4)),
+        # different batch sizes
+        (torch.zeros(2, 3), torch.zeros(3, 3)),
+        ((torch.zeros(2, 3),), (torch.zeros(2, 3), torch.zeros(2, 3))),
+        ({"a": torch.zeros(2, 3)}, {"b": torch.zeros(2, 3)}),
+        ([torch.zeros(2, 3), [1, 2]], [torch.zeros(2, 3), [3, 4]]),
+    ],
+)
+def test_cat_inputs_incompatible(a, b):
+    assert _cat_inputs(a, b) is None
+
+
+def test_training_step_fused_order():
+    ranker = DummyRanker()
+    pos_inputs = torch.tensor([[0.9], [0.8]])
+    neg_inputs = torch.tensor([[0.1], [0.2]])
+
+    # the fused scores are split into positives and negatives in the original order
+    pos_outputs, neg_outputs = torch.sigmoid(
+        ranker(_cat_inputs(pos_inputs, neg_inputs))
+    ).chunk(2)
+    assert torch.equal(pos_outputs, torch.sigmoid(pos_inputs))
+    assert torch.equal(neg_outputs, torch.sigmoid(neg_inputs))
+
+    ranker.batch_sizes = []
+    fused_loss = ranker.training_step((pos_inputs, neg_inputs), 0)
+    assert ranker.batch_sizes == [4]
+
+    ranker.batch_sizes = []
+    ranker.fuse_pairwise_forward = False
+    separate_loss = ranker.training_step((pos_inputs, neg_inputs), 0)
+    assert ranker.batch_sizes == [2, 2]
+    assert torch.allclose(fused_loss, separate_loss)
+
+
+def test_training_step_fallback():
+    ranker = DummyRanker()
+    pos_inputs = torch.tensor([[0.9], [0.8]])
+    neg_inputs = torch.tensor([[0.1, 0.0], [0.2, 0.0]])
+    ranker.training_step((pos_inputs, neg_inputs), 0)
+    assert ranker.batch_sizes == [2, 2]
@@ -0,0 +1,265 @@
+import os
+import tempfile
+from pathlib import Path
+from typing import List
+
+import h5py
+import pytest
+import numpy as np
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("torchmetrics")
+
+from ranking_utils.util import (
+    create_temp_testsets,
+    predict_and_save,
+    rank,
+    read_predictions,
+    write_trec_eval_file,
+)
+from ranking_utils.lightning.datasets import ValTestDatasetBase
+
+
+class DummyValTestDataset(ValTestDatasetBase):
+    def get_single_input(self, query: str, doc: str) -> torch.Tensor:
+        return torch.tensor([float(len(query)), float(len(doc))])
+
+    def collate_fn(self, inputs):
+        q_ids, doc_ids, model_inputs, labels = zip(*inputs)
+        return (
+            torch.LongTensor(q_ids),
+            torch.LongTensor(doc_ids),
+            [torch.stack(model_inputs)],
+            torch.LongTensor(labels),
+        )
+
+
+class DummyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(2, 1)
+
+    def forward(self, inputs):
+        return self.linear(inputs[0])
+
+
+def test_rank_empty_testset(tmp_path: Path):
+    data_file = tmp_path / "data.h5"
+    with h5py.File(data_file, "w") as fp:
+        fp.create_dataset("queries", data=["query"], dtype=h5py.string_dtype())
+        fp.create_dataset("docs", data=["document"], dtype=h5py.string_dtype())
+        fp.create_dataset("orig_q_ids", data=["q1"], dtype=h5py.string_dtype())
+        fp.create_dataset("orig_doc_ids", data=["d1"], dtype=h5py.string_dtype())
+
+    test_file = tmp_path / "test.h5"
+    with h5py.File(test_file, "w") as fp:
+        for name in ("q_ids", "doc_ids", "labels"):
+            fp.create_dataset(name, (0,), dtype="int32")
+
+    testset = DummyValTestDataset(data_file, test_file)
+    assert rank(DummyModel(), testset, batch_size=2, num_workers=0) == {}
+
+
+class DummyTrainer:
+    def __init__(self, log_dir: Path, batches):
+        self.log_dir = str(log_dir)
+        self.local_rank = 0
+        self.batches = batches
+
+    def predict(self):
+        return self.batches
+
+
+class DummyIdDataset:
+    def get_original_query_ids(self, q_ids):
+        return np.array([f"q{i}" for i in q_ids])
+
+    def get_original_document_ids(self, doc_ids):
+        return np.array([f"d{i}" for i in doc_ids])
+
+
+def test_predict_and_save_bfloat16(tmp_path: Path):
+    batches = [
+        {
+            "q_ids": torch.LongTensor([0, 0]),
+            "doc_ids": torch.LongTensor([0, 1]),
+            "predictions": torch.tensor([0.5, 0.25], dtype=torch.bfloat16),
+        }
+    ]
+    predict_and_save(DummyTrainer(tmp_path, batches), DummyIdDataset())
+    with np.load(tmp_path / "predictions_0.npz") as d:
+        assert d["q_ids"].tolist() == ["q0", "q0"]
+        assert d["doc_ids"].tolist() == ["d0", "d1"]
+        assert d["predictions"].dtype == np.float32
+        assert d["predictions"].tolist() == [0.5, 0.25]
+
+
+def test_predict_and_save_no_batches(tmp_path: Path):
+    predict_and_save(DummyTrainer(tmp_path, []), DummyIdDataset())
+    with np.load(tmp_path / "predictions_0.npz") as d:
+        assert len(d["q_ids"]) == len(d["doc_ids"]) == 0
+        assert d["predictions"].dtype == np.float32
+
+
+@pytest.fixture
+def data_file(tmp_path: Path) -> Path:
+    f = tmp_path / "data.h5"
+    with h5py.File(f, "w") as fp:
+        fp.create_dataset("orig_q_ids", data=["q1", "q2"], dtype=h5py.string_dtype())
+        fp.create_dataset(
+            "orig_doc_ids", data=["d1", "d2", "d3"], dtype=h5py.string_dtype()
+        )
+    return f
+
+
+@pytest.fixture
+def runfiles(tmp_path: Path) -> List[Path]:
+    contents = ["q2 Q0 d3 1 1.0 x\nq1 Q0 d1 1 1.0 x\n", "q1 Q0 d2 1 1.0 x\n", ""]
+    files = []
+    for i, content in enumerate(contents):
+        f = tmp_path / f"run_{i}.tsv"
+        f.write_text(content)
+        files.append(f)
+    return files
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_create_temp_testsets(data_file: Path, runfiles: List[Path], num_workers: int):
+    result = create_temp_testsets(data_file, runfiles, num_workers=num_workers)
+    expected = [([1, 0], [2, 0]), ([0], [1]), ([], [])]
+    assert len(result) == len(expected)
+    for (fd, f), (q_ids, doc_ids) in zip(result, expected):
+        with h5py.File(f, "r") as fp:
+            assert fp["q_ids"][:].tolist() == q_ids
+            assert fp["doc_ids"][:].tolist() == doc_ids
+            assert fp["labels"][:].tolist() == [0] * len(q_ids)
+        os.close(fd)
+        os.remove(f)
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_create_temp_testsets_cleanup(
+    data_file: Path,
+    runfiles: List[Path],
+    num_workers: int,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    temp_dir = tmp_path / "temp"
+    temp_dir.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(temp_dir))
+    runfiles[1].write_text("qX Q0 d2 1 1.0 x\n")
+    with pytest.raises(KeyError):
+        create_temp_testsets(data_file, runfiles, num_workers=num_workers)
+    assert list(temp_dir.iterdir()) == []
+
+
+def test_create_temp_testsets_invalid_num_workers(
+    data_file: Path, runfiles: List[Path]
+):
+    with pytest.raises(ValueError):
+        create_temp_testsets(data_file, runfiles, num_workers=0)
+
+
+def save_predictions(f: Path, q_ids: List[str], doc_ids: List[str], scores: List[float]):
+    np.savez_compressed(
+        f,
+        q_ids=np.array(q_ids, dtype=str),
+        doc_ids=np.array(doc_ids, dtype=str),
+        predictions=np.array(scores, dtype=np.float32),
+    )
+
+
+def test_read_predictions(tmp_path: Path):
+    save_predictions(
+        tmp_path / "predictions_0.npz",
+        ["q1", "q2", "q1"],
+        ["d1", "d1", "d2"],
+        [0.5, 0.25, 0.75],
+    )
+    save_predictions(
+        tmp_path / "predictions_1.npz", ["q1", "q2"], ["d1", "d2"], [0.125, 0.5]
+    )
+    predictions = read_predictions(
+        [tmp_path / "predictions_0.npz", tmp_path / "predictions_1.npz"]
+    )
+
+    assert predictions.keys() == {"q1", "q2"}
+    for doc_ids, scores in predictions.values():
+        assert isinstance(doc_ids, np.ndarray)
+        assert isinstance(scores, np.ndarray)
+        assert scores.dtype == np.float32
+
+    # the last score of a duplicate query-document pair is used
+    doc_ids, scores = predictions["q1"]
+    assert dict(zip(doc_ids.tolist(), scores.tolist())) == {"d1": 0.125, "d2": 0.75}
+    doc_ids, scores = predictions["q2"]
+    assert dict(zip(doc_ids.tolist(), scores.tolist())) == {"d1": 0.25, "d2": 0.5}
+
+
+def test_read_predictions_no_files():
+    assert read_predictions([]) == {}
+
+
+class DocLengthModel(torch.nn.Module):
+    def forward(self, inputs):
+        # the score is the document length
+        return inputs[0][:, 1:]
+
+
+def test_rank(tmp_path: Path):
+    data_file = tmp_path / "data.h5"
+    with h5py.File(data_file, "w") as fp:
+        fp.create_dataset("queries", data=["q", "qq"], dtype=h5py.string_dtype())
+        fp.create_dataset("docs", data=["a", "bbb", "cc"], dtype=h5py.string_dtype())
+        fp.create_dataset("orig_q_ids", data=["q1", "q2"], dtype=h5py.string_dtype())
+        fp.create_dataset(
+            "orig_doc_ids", data=["d1", "d2", "d3"], dtype=h5py.string_dtype()
+        )
+
+    test_file = tmp_path / "test.h5"
+    with h5py.File(test_file, "w") as fp:
+        fp.create_dataset("q_ids", data=[0, 0, 1], dtype="int32")
+        fp.create_dataset("doc_ids", data=[0, 1, 2], dtype="int32")
+        fp.create_dataset("labels", (3,), dtype="int32")
+
+    testset = DummyValTestDataset(data_file, test_file)
+    predictions = rank(DocLengthModel(), testset, batch_size=2, num_workers=0)
+    assert predictions.keys() == {"q1", "q2"}
+    doc_ids, scores = predictions["q1"]
+    assert doc_ids.tolist() == ["d1", "d2"]
+    assert scores.dtype == np.float32
+    assert scores.tolist() == [1.0, 3.0]
+    doc_ids, scores = predictions["q2"]
+    assert doc_ids.tolist() == ["d3"]
+    assert scores.tolist() == [2.0]
+
+
+def test_read_predictions_write_trec_eval_file(tmp_path: Path):
+    # interleaved queries, q2/d1 is duplicated, q1/d2 and q1/d3 are tied
+    save_predictions(
+        tmp_path / "predictions_0.npz",
+        ["q2", "q1", "q2", "q1"],
+        ["d3", "d3", "d1", "d1"],
+        [0.5, 0.5, 0.75, 0.75],
+    )
+    # a rank without any predictions
+    save_predictions(tmp_path / "predictions_1.npz", [], [], [])
+    save_predictions(
+        tmp_path / "predictions_2.npz", ["q2", "q1"], ["d1", "d2"], [0.25, 0.5]
+    )
+    predictions = read_predictions(
+        [tmp_path / f"predictions_{i}.npz" for i in range(3)]
+    )
+
+    out_file = tmp_path / "out" / "run.tsv"
+    write_trec_eval_file(out_file, predictions, "method")
+    # ties are broken by document ID
+    assert out_file.read_text(encoding="utf-8").splitlines() == [
+        "q1\tQ0\td1\t1\t0.75\tmethod",
+        "q1\tQ0\td2\t2\t0.5\tmethod",
+        "q1\tQ0\td3\t3\t0.5\tmethod",
+        "q2\tQ0\td3\t1\t0.5\tmethod",
+        "q2\tQ0\td1\t2\t0.25\tmethod",
+    ]